@@ -1,24 +1,69 @@
-from flask import Flask, send_file, jsonify, request, make_response
+if __name__ == '__main__':
+    # gunicorn's gevent workers patch for themselves; the Celery prefork
+    # worker must stay unpatched, so only patch for local runs
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
+import orjson
 import qrcode
 from io import BytesIO
 import uuid
+import base64
+import re
 from datetime import datetime, timedelta
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
-from reportlab.lib.utils import ImageReader
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
+from bson.binary import Binary, UUID_SUBTYPE
+from cachetools import TTLCache
+from celery import Celery
+from celery.signals import worker_process_init
 from dotenv import load_dotenv
 import os
+import time
 
 # Load environment variables
 load_dotenv()
 
+class OrJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson"""
+    
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if kwargs.get('indent'):
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+app.json = OrJSONProvider(app)
+
+# Coupon PDFs are rendered by a Celery worker (see Procfile)
+REDIS_URL = os.getenv('REDIS_URL', 'redis://localhost:6379/0')
+celery = Celery('app', broker=REDIS_URL)
 
 # MongoDB Atlas connection
 MONGO_URI = os.getenv('MONGODB_URI')
 MASTER_IP = os.getenv('MASTER_IP', '192.168.137.1')
 
+# Connections per process; gunicorn.conf.py sizes worker_connections from this
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', 10))
+
+# Format of coupon IDs issued before they were stored as binary UUIDs
+LEGACY_COUPON_ID = re.compile(r'[0-9a-f]{8}')
+
+# Expired coupons are kept this long for auditing before MongoDB deletes them
+COUPON_RETENTION_SECONDS = 24 * 60 * 60
+
+# A coupon still without a PDF this long after creation is rendered on download
+PDF_RENDER_GRACE_SECONDS = 60
+
 def init_mongodb():
     try:
         # Add TLS/SSL certificates and additional options
@@ -26,7 +71,12 @@ def init_mongodb():
                            tls=True, 
                            tlsAllowInvalidCertificates=True,
                            retryWrites=True,
-                           serverSelectionTimeoutMS=5000)
+                           serverSelectionTimeoutMS=5000,
+                           # Bound the pool so multiple workers stay within Atlas connection limits
+                           maxPoolSize=MONGO_MAX_POOL_SIZE,
+                           minPoolSize=1,
+                           maxIdleTimeMS=30000,
+                           waitQueueTimeoutMS=2000)
         
         db = client.coupon_system
         
@@ -37,6 +87,17 @@ def init_mongodb():
         # Initialize collections
         coupons_collection = db.coupons
         config_collection = db.config
+        coupon_pdfs = db.coupon_pdfs
+        
+        # TTL indexes expire old coupons and their PDFs (idempotent). A failed
+        # build is logged but must not take the collections down with it.
+        try:
+            coupons_collection.create_index('expiry_date',
+                                            expireAfterSeconds=COUPON_RETENTION_SECONDS)
+            coupon_pdfs.create_index('expiry_date',
+                                     expireAfterSeconds=COUPON_RETENTION_SECONDS)
+        except Exception as e:
+            print(f"Error creating MongoDB indexes: {e}")
         
         # Initialize coupon limit if not exists
         if not config_collection.find_one({'_id': 'coupon_limit'}):
@@ -46,51 +107,126 @@ def init_mongodb():
                 'current_count': 0
             })
             
-        return db, coupons_collection, config_collection
+        return db, coupons_collection, config_collection, coupon_pdfs
         
     except Exception as e:
         print(f"Error connecting to MongoDB: {e}")
-        return None, None, None
+        return None, None, None, None
 
 
 
 
 # Initialize MongoDB connections
-db, coupons_collection, config_collection = init_mongodb()
+db, coupons_collection, config_collection, coupon_pdfs = init_mongodb()
+
+@worker_process_init.connect
+def init_worker_mongodb(**kwargs):
+    """Give each forked Celery worker process its own MongoDB client"""
+    global db, coupons_collection, config_collection, coupon_pdfs
+    db, coupons_collection, config_collection, coupon_pdfs = init_mongodb()
 
 
 def is_ip_allowed(ip):
     """Check if IP has never generated a coupon before or is master IP"""
-    return ip == MASTER_IP or not coupons_collection.find_one({'generating_ip': ip})
+    return ip == MASTER_IP or not coupons_collection.find_one({'generating_ip': ip},
+                                                              projection={'_id': 1})
 
-def can_generate_coupon():
-    """Check if the coupon limit has been reached"""
-    config = config_collection.find_one({'_id': 'coupon_limit'})
-    return config['current_count'] < config['limit']
+# In-process cache of the coupon_limit config document
+_config_cache = {'doc': None, 'ts': 0}
 
-def increment_coupon_count():
-    """Increment the current coupon count"""
-    config_collection.update_one(
-        {'_id': 'coupon_limit'},
-        {'$inc': {'current_count': 1}}
+def _cache_config(doc):
+    """Store a fresh coupon_limit document in the cache"""
+    _config_cache['doc'] = doc
+    _config_cache['ts'] = time.monotonic()
+
+def invalidate_config():
+    """Drop the cached coupon_limit document"""
+    _config_cache['doc'] = None
+    _config_cache['ts'] = 0
+
+def get_config(max_age=5):
+    """Return the coupon_limit document, refreshing it if older than max_age seconds"""
+    if _config_cache['doc'] is None or time.monotonic() - _config_cache['ts'] >= max_age:
+        _cache_config(config_collection.find_one({'_id': 'coupon_limit'}))
+    return _config_cache['doc']
+
+def reserve_coupon_slot():
+    """Atomically increment the coupon count if the limit has not been reached"""
+    config = config_collection.find_one_and_update(
+        {'_id': 'coupon_limit', '$expr': {'$lt': ['$current_count', '$limit']}},
+        {'$inc': {'current_count': 1}},
+        return_document=ReturnDocument.AFTER
     )
+    if config is None:
+        return False
+    _cache_config(config)
+    return True
+
+def release_coupon_slot():
+    """Give back a slot taken by reserve_coupon_slot"""
+    _cache_config(config_collection.find_one_and_update(
+        {'_id': 'coupon_limit'},
+        {'$inc': {'current_count': -1}},
+        return_document=ReturnDocument.AFTER
+    ))
+
+def encode_coupon_id(raw):
+    """Encode raw UUID bytes as an unpadded URL-safe base64 coupon ID"""
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode()
+
+def new_coupon_id():
+    """Return a random coupon ID as a URL-safe base64 string of a UUID4"""
+    return encode_coupon_id(uuid.uuid4().bytes)
+
+def coupon_key(coupon_id):
+    """Return the _id for a coupon ID string, or None if it is malformed"""
+    # Coupons issued before binary IDs are stored under 8 hex characters
+    if LEGACY_COUPON_ID.fullmatch(coupon_id):
+        return coupon_id
+    if len(coupon_id) != 22:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(coupon_id + '==')
+    except ValueError:
+        return None
+    # urlsafe_b64decode silently skips characters outside the alphabet
+    if encode_coupon_id(raw) != coupon_id:
+        return None
+    return Binary(raw, UUID_SUBTYPE)
 
 def generate_qr_code(data):
-    """Generate QR code and return the image"""
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
+    """Generate QR code and return its module matrix, including the border"""
+    # Coupon IDs are always 22 bytes, which fits version 2-L, so skip
+    # version fitting and the 8-way mask scoring pass
+    qr = qrcode.QRCode(version=2,
+                       error_correction=qrcode.constants.ERROR_CORRECT_L,
+                       border=5,
+                       mask_pattern=0)
     qr.add_data(data)
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    img_buffer = BytesIO()
-    img.save(img_buffer)
-    img_buffer.seek(0)
-    return img_buffer
+    qr.make(fit=False)
+    return qr.get_matrix()
 
-def create_coupon_pdf(coupon_id, qr_img_buffer, expiry_date):
-    """Create a PDF with the coupon and QR code"""
-    pdf_buffer = BytesIO()
-    c = canvas.Canvas(pdf_buffer, pagesize=letter)
+def draw_qr_code(c, qr_matrix, x, y, size):
+    """Draw a QR module matrix onto the canvas as a single vector path"""
+    module = size / len(qr_matrix)
+    path = c.beginPath()
+    for row_index, row in enumerate(qr_matrix):
+        row_y = y + size - (row_index + 1) * module
+        col = 0
+        while col < len(row):
+            if not row[col]:
+                col += 1
+                continue
+            # Merge each run of dark modules into one rectangle
+            start = col
+            while col < len(row) and row[col]:
+                col += 1
+            path.rect(x + start * module, row_y, (col - start) * module, module)
+    c.drawPath(path, stroke=0, fill=1)
+
+def create_coupon_pdf(coupon_id, qr_matrix, expiry_date, out):
+    """Write a PDF with the coupon and QR code to the file object out"""
+    c = canvas.Canvas(out, pagesize=letter)
     width, height = letter
     
     # Add decorative border
@@ -113,14 +249,13 @@ def create_coupon_pdf(coupon_id, qr_img_buffer, expiry_date):
     c.drawCentredString(width/2, height-180, "Present this QR code at checkout")
     
     # Add QR code
-    qr_img = ImageReader(qr_img_buffer)
-    c.drawImage(qr_img, width/2-100, height/2-100, 200, 200)
+    draw_qr_code(c, qr_matrix, width/2-100, height/2-100, 200)
     
     # Add coupon details
     c.setFont("Helvetica", 12)
     c.drawCentredString(width/2, height/2-150, f"Coupon ID: {coupon_id}")
     c.drawCentredString(width/2, height/2-170, 
-                       f"Valid until: {expiry_date.strftime('%Y-%m-%d %H:%M:%S')}")
+                       f"Valid until: {expiry_date.strftime('%Y-%m-%d %H:%M:%S')} UTC")
     
     # Add terms and conditions
     c.setFont("Helvetica", 10)
@@ -129,8 +264,62 @@ def create_coupon_pdf(coupon_id, qr_img_buffer, expiry_date):
     c.drawCentredString(width/2, 60, "Valid only at Swaad Station")
     
     c.save()
-    pdf_buffer.seek(0)
-    return pdf_buffer
+
+def coupon_pdf_filename(coupon_id):
+    """Return the download filename for a coupon PDF"""
+    return f'swaad_station_coupon_{coupon_id}.pdf'
+
+def store_coupon_pdf(coupon_id, expiry_date):
+    """Render a coupon PDF, store it alongside the coupon and return its bytes"""
+    qr_matrix = generate_qr_code(coupon_id)
+    
+    pdf_buffer = BytesIO()
+    create_coupon_pdf(coupon_id, qr_matrix, expiry_date, pdf_buffer)
+    # A coupon PDF is ~13 KB, so one document is enough and expires with the coupon.
+    # Upsert so a redelivered or retried task stays idempotent.
+    key = coupon_key(coupon_id)
+    coupon_pdfs.replace_one({'_id': key}, {
+        '_id': key,
+        'data': pdf_buffer.getvalue(),
+        'expiry_date': expiry_date
+    }, upsert=True)
+    return pdf_buffer.getvalue()
+
+@celery.task(autoretry_for=(Exception,), retry_backoff=True, max_retries=5, acks_late=True)
+def render_coupon_pdf(coupon_id, expiry_iso):
+    """Render a coupon PDF in the background"""
+    store_coupon_pdf(coupon_id, datetime.fromisoformat(expiry_iso))
+
+def static_json(payload):
+    """Serialize a constant JSON payload once, exactly as jsonify would"""
+    return app.json.response(payload).get_data()
+
+def json_response(body, status=200):
+    """Build a response from a pre-serialized JSON body"""
+    return app.response_class(body, status=status, mimetype=app.json.mimetype)
+
+# Constant rejection bodies, serialized once at startup
+ERR_COUPON_COOKIE = static_json({
+    'error': 'Coupon generation not allowed',
+    'message': 'You have already generated a coupon. Only one coupon per device is allowed.'
+})
+ERR_COUPON_LIMIT = static_json({
+    'error': 'Coupon generation not allowed',
+    'message': 'Coupon limit reached. Please try again later.'
+})
+ERR_UNAUTHORIZED = static_json({'error': 'Unauthorized'})
+ERR_PDF_NOT_FOUND = static_json({'status': 'error', 'message': 'Coupon not found'})
+ERR_PDF_PENDING = static_json({
+    'status': 'pending',
+    'message': 'Coupon PDF is not ready yet. Please try again shortly.'
+})
+INVALID_NOT_FOUND = static_json({'valid': False, 'message': 'Coupon not found'})
+INVALID_USED = static_json({'valid': False, 'message': 'Coupon already used'})
+INVALID_EXPIRED = static_json({'valid': False, 'message': 'Coupon expired'})
+
+# Recent validation rejections, so repeated scans of a bad QR code skip MongoDB.
+# Rejections are final: coupons never become unused or unexpired again.
+_validate_rejections = TTLCache(maxsize=10_000, ttl=60)
 
 @app.route('/test_db')
 def test_db():
@@ -153,57 +342,58 @@ def test_db():
 
 @app.route('/generate_coupon')
 def generate_coupon():
-    """Generate a new coupon and return as PDF"""
+    """Generate a new coupon and queue its PDF for rendering"""
     try:
         # Check for an existing cookie
         if request.cookies.get('coupon_generated'):
-            return jsonify({
-                'error': 'Coupon generation not allowed',
-                'message': 'You have already generated a coupon. Only one coupon per device is allowed.'
-            }), 403
+            return json_response(ERR_COUPON_COOKIE, 403)
         
         client_ip = request.remote_addr
         
-        # Check if coupon limit reached
-        if not can_generate_coupon() and client_ip != MASTER_IP:
-            return jsonify({
-                'error': 'Coupon generation not allowed',
-                'message': 'Coupon limit reached. Please try again later.'
-            }), 403
-        
         # Generate coupon
-        coupon_id = str(uuid.uuid4())[:8]
-        expiry_date = datetime.now() + timedelta(days=1)
+        coupon_id = new_coupon_id()
+        expiry_date = datetime.utcnow() + timedelta(days=1)
         
         # Store coupon in MongoDB
         coupon_data = {
-            '_id': coupon_id,
+            '_id': coupon_key(coupon_id),
             'valid': True,
             'expiry_date': expiry_date,
             'discount': '10%',
             'used': False,
             'generating_ip': client_ip,
             'generated_by_master': client_ip == MASTER_IP,
-            'created_at': datetime.now()
+            'created_at': datetime.utcnow()
         }
         
-        coupons_collection.insert_one(coupon_data)
+        # Reserve a slot under the coupon limit if not master IP
+        reserved = client_ip != MASTER_IP
+        if reserved and not reserve_coupon_slot():
+            return json_response(ERR_COUPON_LIMIT, 403)
         
-        # Increment coupon count if not master IP
-        if client_ip != MASTER_IP:
-            increment_coupon_count()
+        try:
+            coupons_collection.insert_one(coupon_data)
+        except Exception:
+            if reserved:
+                release_coupon_slot()
+            raise
         
-        # Generate and return PDF
-        qr_buffer = generate_qr_code(coupon_id)
-        pdf_buffer = create_coupon_pdf(coupon_id, qr_buffer, expiry_date)
+        # Render the PDF in the background and point the client at its download URL
+        try:
+            render_coupon_pdf.delay(coupon_id, expiry_date.isoformat())
+        except Exception:
+            # Nothing will ever render this coupon, so undo it
+            coupons_collection.delete_one({'_id': coupon_data['_id']})
+            if reserved:
+                release_coupon_slot()
+            raise
         
         # Set a cookie to prevent further generation
-        response = make_response(send_file(
-            pdf_buffer,
-            mimetype='application/pdf',
-            as_attachment=True,
-            download_name=f'swaad_station_coupon_{coupon_id}.pdf'
-        ))
+        response = jsonify({
+            'status': 'queued',
+            'url': f'/coupon/{coupon_id}.pdf'
+        })
+        response.status_code = 202
         response.set_cookie('coupon_generated', 'true', max_age=24 * 60 * 60)  # 1-day expiration
         
         return response
@@ -214,26 +404,79 @@ def generate_coupon():
             'message': str(e)
         }), 500
     
+@app.route('/coupon/<coupon_id>.pdf')
+def download_coupon(coupon_id):
+    """Download a rendered coupon PDF"""
+    try:
+        key = coupon_key(coupon_id)
+        # Legacy coupons were downloaded directly and have no stored PDF
+        if key is None or isinstance(key, str):
+            return json_response(ERR_PDF_NOT_FOUND, 404)
+        
+        pdf = coupon_pdfs.find_one({'_id': key}, projection={'data': 1})
+        if pdf:
+            pdf_data = pdf['data']
+        else:
+            # Tell a coupon that is still rendering apart from an unknown ID
+            coupon = coupons_collection.find_one({'_id': key},
+                                                 projection={'expiry_date': 1, 'created_at': 1})
+            if not coupon:
+                return json_response(ERR_PDF_NOT_FOUND, 404)
+            
+            # Give the worker time first, then render here so a render that
+            # failed for good cannot leave the client polling forever
+            if datetime.utcnow() - coupon['created_at'] < timedelta(seconds=PDF_RENDER_GRACE_SECONDS):
+                return json_response(ERR_PDF_PENDING, 202)
+            pdf_data = store_coupon_pdf(coupon_id, coupon['expiry_date'])
+        
+        return app.response_class(
+            pdf_data,
+            mimetype='application/pdf',
+            headers={
+                'Content-Disposition': f'attachment; filename={coupon_pdf_filename(coupon_id)}'
+            }
+        )
+        
+    except Exception as e:
+        return jsonify({
+            'status': 'error',
+            'message': str(e)
+        }), 500
+
 @app.route('/validate_coupon/<coupon_id>')
 def validate_coupon(coupon_id):
     """Validate a coupon"""
     try:
-        coupon = coupons_collection.find_one({'_id': coupon_id})
-        
-        if not coupon:
-            return jsonify({'valid': False, 'message': 'Coupon not found'})
+        key = coupon_key(coupon_id)
+        if key is None:
+            return json_response(INVALID_NOT_FOUND)
         
-        if coupon['used']:
-            return jsonify({'valid': False, 'message': 'Coupon already used'})
+        rejection = _validate_rejections.get(coupon_id)
+        if rejection is not None:
+            return json_response(rejection)
         
-        if datetime.now() > coupon['expiry_date']:
-            return jsonify({'valid': False, 'message': 'Coupon expired'})
-        
-        coupons_collection.update_one(
-            {'_id': coupon_id},
-            {'$set': {'used': True}}
+        # Mark the coupon used only if it is unused and unexpired, checked server-side
+        coupon = coupons_collection.find_one_and_update(
+            {'_id': key, 'used': False, '$expr': {'$gt': ['$expiry_date', '$$NOW']}},
+            [{'$set': {'used': True}}],
+            projection={'discount': 1},
+            return_document=ReturnDocument.AFTER
         )
         
+        if not coupon:
+            # Look the coupon up once more to report why it was rejected
+            coupon = coupons_collection.find_one({'_id': key}, projection={'used': 1})
+            
+            if not coupon:
+                rejection = INVALID_NOT_FOUND
+            elif coupon['used']:
+                rejection = INVALID_USED
+            else:
+                rejection = INVALID_EXPIRED
+            
+            _validate_rejections[coupon_id] = rejection
+            return json_response(rejection)
+        
         return jsonify({
             'valid': True,
             'message': 'Valid coupon - 10% discount applied at Swaad Station',
@@ -251,7 +494,7 @@ def reset_limit():
     """Reset or update the coupon limit (only accessible from master IP)"""
     try:
         if request.remote_addr != MASTER_IP:
-            return jsonify({'error': 'Unauthorized'}), 403
+            return json_response(ERR_UNAUTHORIZED, 403)
         
         new_limit = request.json.get('limit', 150)
         
@@ -262,6 +505,7 @@ def reset_limit():
                 'current_count': 0
             }}
         )
+        invalidate_config()
         
         return jsonify({
             'message': f'Coupon limit reset to {new_limit}',
@@ -274,18 +518,30 @@ def reset_limit():
             'message': str(e)
         }), 500
 
+# Computes all admin stats counts in a single round-trip
+COUPON_STATS_PIPELINE = [
+    {'$facet': {
+        'total': [{'$count': 'n'}],
+        'master': [{'$match': {'generated_by_master': True}}, {'$count': 'n'}],
+        'used': [{'$match': {'used': True}}, {'$count': 'n'}],
+        'unique_ips': [{'$group': {'_id': '$generating_ip'}}, {'$count': 'n'}]
+    }}
+]
+
 @app.route('/admin/stats')
 def admin_stats():
     """Get statistics about generated coupons (only accessible from master IP)"""
     try:
         if request.remote_addr != MASTER_IP:
-            return jsonify({'error': 'Unauthorized'}), 403
+            return json_response(ERR_UNAUTHORIZED, 403)
         
-        config = config_collection.find_one({'_id': 'coupon_limit'})
-        total_coupons = coupons_collection.count_documents({})
-        master_generated = coupons_collection.count_documents({'generated_by_master': True})
-        used_coupons = coupons_collection.count_documents({'used': True})
-        unique_users = len(coupons_collection.distinct('generating_ip'))
+        config = get_config()
+        stats = next(coupons_collection.aggregate(COUPON_STATS_PIPELINE))
+        counts = {key: value[0]['n'] if value else 0 for key, value in stats.items()}
+        total_coupons = counts['total']
+        master_generated = counts['master']
+        used_coupons = counts['used']
+        unique_users = counts['unique_ips']
         
         return jsonify({
             'total_coupons_generated': total_coupons,
@@ -304,4 +560,5 @@ def admin_stats():
         }), 500
 
 if __name__ == '__main__':
-    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)))
+    from gevent.pywsgi import WSGIServer
+    WSGIServer(("0.0.0.0", int(os.environ.get("PORT", 5000))), app).serve_forever()
@@ -0,0 +1,12 @@
+import os
+
+# Production server settings, picked up automatically by `gunicorn app:app`
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = 'gevent'
+workers = os.cpu_count()
+# Each request holds one MongoDB socket at a time for a few short operations,
+# so allow ~5 in-flight requests per pooled socket (see MONGO_MAX_POOL_SIZE in
+# app.py). That keeps pool waits far below waitQueueTimeoutMS; extra
+# connections wait in the listen backlog instead of failing with 500s.
+worker_connections = 5 * int(os.environ.get('MONGO_MAX_POOL_SIZE', 10))
+keepalive = 5